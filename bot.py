@@ -1,133 +1,306 @@
 import os
-from datetime import datetime, timedelta, timezone
+import asyncio
+import hashlib
+import re
+from time import monotonic
+from datetime import date, datetime, time, timedelta, timezone
 from dotenv import load_dotenv
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from langchain.prompts import ChatPromptTemplate
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+from telegram.constants import ChatAction
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-import pickle
-from openai import OpenAI
+from googleapiclient.http import build_http
+import google_auth_httplib2
+import threading
+import httpx
+import orjson
+from openai import AsyncOpenAI
 import logging
-
-# Logging template
-logging.basicConfig(filename="bot.log",encoding="utf-8", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # Load environment variables
 load_dotenv()
 
 # Google Calendar API setup
 SCOPES = ['https://www.googleapis.com/auth/calendar']
+YEKAT_TZ = timezone(timedelta(hours=5))  # UTC+5 for Yekaterinburg
 model = 'qwen/qwen-2-7b-instruct:free'
 
+# OpenRouter client, shared across requests so connections are kept alive
+openai_client = AsyncOpenAI(
+    base_url="https://openrouter.ai/api/v1",
+    api_key=os.getenv("OPENROUTER_API_KEY"),
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=30,
+    ),
+)
+
+_service = None
+_service_creds = None
+_service_lock = threading.Lock()
+
 def get_google_calendar_service():
-    """Set up and return Google Calendar service."""
-    creds = None
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+    """Set up and return Google Calendar service.
+
+    The service is built once and reused; credentials are refreshed in place
+    when they expire.
+    """
+    global _service, _service_creds
+    with _service_lock:
+        if _service is not None and _service_creds.valid:
+            return _service
+
+        creds = _service_creds
+        if creds is None and os.path.exists('token.json'):
+            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+
+            with open('token.json', 'w', encoding='utf-8') as token:
+                token.write(creds.to_json())
+
+        # The built client holds a reference to creds, so a refresh above is
+        # picked up without rebuilding it.
+        if _service is None or creds is not _service_creds:
+            _service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+        _service_creds = creds
+        return _service
+
+_thread_http = threading.local()
+
+def execute_request(request):
+    """Execute a Google API request with an HTTP transport owned by the current thread.
+
+    The cached service is shared between worker threads, but httplib2 is not
+    thread-safe, so each thread gets its own authorized transport.
+    """
+    http = getattr(_thread_http, 'http', None)
+    if http is None or http.credentials is not _service_creds:
+        http = google_auth_httplib2.AuthorizedHttp(_service_creds, http=build_http())
+        _thread_http.http = http
+    return request.execute(http=http)
 
-    return build('calendar', 'v3', credentials=creds)
+# Response format for classifying the request and extracting event details in one call
+REQUEST_KEYS = ('type',)
+EVENT_KEYS = ('title', 'date', 'time')
 
-# LangChain setup for request classification
-request_type_schema = [
-    ResponseSchema(name="type", description="Type of request: 'add_event' or 'show_today'"),
-    ResponseSchema(name="original_text", description="Original text if type is add_event")
-]
+REQUEST_FORMAT_INSTRUCTIONS = """The output should be a markdown code snippet formatted in the following schema, including the leading and trailing "```json" and "```":
 
-request_classifier = StructuredOutputParser.from_response_schemas(request_type_schema)
+```json
+{
+	"type": string  // Type of request: 'add_event' or 'show_today'
+	"event_type": string  // Type of calendar event (meeting, task, etc.) if type is add_event
+	"title": string  // Title or description of the event if type is add_event
+	"date": string  // Date of the event if type is add_event
+	"time": string  // Time of the event if type is add_event
+	"person": string  // Person involved in the event (if any)
+	"event_duration": float  // Duration of event
+}
+```"""
 
-classifier_prompt = ChatPromptTemplate.from_template("""
-Classify the following request into one of these types:
+JSON_BLOCK_RE = re.compile(r'```json\s*(\{.*?\})\s*```', re.S)
+JSON_OBJECT_RE = re.compile(r'(\{.*\})', re.S)
+
+def parse_llm_json(text: str) -> dict:
+    """Extract the JSON object from an LLM response and check it has the request type."""
+    match = JSON_BLOCK_RE.search(text) or JSON_OBJECT_RE.search(text)
+    if match is None:
+        raise ValueError(f"No JSON object found in model response: {text}")
+    result = orjson.loads(match.group(1))
+    missing = [key for key in REQUEST_KEYS if key not in result]
+    if missing:
+        raise ValueError(f"Model response is missing keys: {', '.join(missing)}")
+    return result
+
+# The instructions never change, so they go first in a system message and the
+# user text follows; providers can then reuse the cached prompt prefix
+REQUEST_SYSTEM_PROMPT = """Classify the user's request into one of these types:
 1. add_event - when user wants to add an event to calendar
 2. show_today - when user wants to see today's meta-events
 
-Text: {text}
+If the type is add_event, also extract calendar event information from the request. If any information is missing, leave it blank.
+
+""" + REQUEST_FORMAT_INSTRUCTIONS
+
+if model.startswith('anthropic/'):
+    # Anthropic models only cache prompt prefixes that are explicitly marked
+    REQUEST_SYSTEM_MESSAGE = {
+        "role": "system",
+        "content": [{"type": "text", "text": REQUEST_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+    }
+else:
+    REQUEST_SYSTEM_MESSAGE = {"role": "system", "content": REQUEST_SYSTEM_PROMPT}
+
+def build_request_messages(text: str) -> list:
+    """Return the chat messages asking the LLM to classify and parse a user request."""
+    return [REQUEST_SYSTEM_MESSAGE, {"role": "user", "content": text}]
+
+# Cache of parsed LLM responses, keyed by model and prompt
+LLM_CACHE_TTL = 3600  # seconds
+LLM_CACHE_MAX_SIZE = 1024
+_llm_cache = {}
+
+def llm_cache_key(messages) -> str:
+    """Return a stable cache key for a completion request."""
+    payload = orjson.dumps({"model": model, "messages": messages}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+# Completions currently in flight, keyed like the cache, so identical
+# concurrent requests share one call
+_inflight = {}
+
+async def fetch_llm(key: str, messages) -> dict:
+    """Run a completion, parse it and store the result in the cache."""
+    try:
+        completion = await openai_client.chat.completions.create(
+            extra_headers={
+                "HTTP-Referer": "",
+                "X-Title": "",
+            },
+            model=model,
+            messages=messages
+        )
+        result = parse_llm_json(completion.choices[0].message.content)
+        if len(_llm_cache) >= LLM_CACHE_MAX_SIZE:
+            # Dicts keep insertion order, so the first key is the oldest entry
+            del _llm_cache[next(iter(_llm_cache))]
+        _llm_cache[key] = (monotonic() + LLM_CACHE_TTL, result)
+        return result
+    finally:
+        del _inflight[key]
+
+async def ask_llm(messages) -> dict:
+    """Run a completion and parse it, reusing cached results for repeated prompts."""
+    key = llm_cache_key(messages)
+    cached = _llm_cache.get(key)
+    if cached is not None:
+        expires_at, result = cached
+        if expires_at > monotonic():
+            return result
+        del _llm_cache[key]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch_llm(key, messages))
+        _inflight[key] = task
+    # Shield the shared call so one cancelled caller does not cancel it for the others
+    return await asyncio.shield(task)
 
-{format_instructions}
-""")
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different phrasings share a cache entry."""
+    return ' '.join(text.split())
 
-# LangChain setup for event parsing
-event_schemas = [
-    ResponseSchema(name="event_type", description="Type of calendar event (meeting, task, etc.)"),
-    ResponseSchema(name="title", description="Title or description of the event"),
-    ResponseSchema(name="date", description="Date of the event"),
-    ResponseSchema(name="time", description="Time of the event"),
-    ResponseSchema(name="person", description="Person involved in the event (if any)"),
-    ResponseSchema(name="event_duration", description="Duration of event", type='float')
-]
+# Whole messages that can only be a request for today's events; anything
+# else (e.g. with a time, another day or an event to add) goes to the LLM
+SHOW_TODAY_PHRASES = frozenset({
+    "what's on today",
+    "what's on my schedule today",
+    "what's on my calendar today",
+    "what's on my agenda today",
+    "what do i have today",
+    "show today",
+    "show today's events",
+    "show my schedule for today",
+    "today's events",
+    "today's schedule",
+    "schedule for today",
+    "что у меня сегодня",
+    "что сегодня",
+    "расписание на сегодня",
+    "покажи расписание на сегодня",
+    "события на сегодня",
+    "дела на сегодня",
+})
+PHRASE_TRIM_RE = re.compile(r'^[\s.!?]+|[\s.!?]+$')
 
-event_parser = StructuredOutputParser.from_response_schemas(event_schemas)
+def classify_without_llm(text: str):
+    """Return request details for messages that only ask for today's events, otherwise None.
 
-event_prompt = ChatPromptTemplate.from_template("""
-Extract calendar event information from the following text. If any information is missing, leave it blank.
+    >>> classify_without_llm("What's on my schedule today?")
+    {'type': 'show_today'}
+    >>> classify_without_llm("Расписание на сегодня")
+    {'type': 'show_today'}
+    >>> classify_without_llm("Schedule lunch with Anna tomorrow at 3pm") is None
+    True
+    >>> classify_without_llm("Call mom today at 5pm") is None
+    True
+    >>> classify_without_llm("Dentist today 17.30") is None
+    True
+    >>> classify_without_llm("Обед с Павлом сегодня в 13") is None
+    True
+    """
+    phrase = PHRASE_TRIM_RE.sub('', ' '.join(text.lower().replace('\u2019', "'").split()))
+    if phrase in SHOW_TODAY_PHRASES:
+        return {'type': 'show_today'}
+    return None
 
-Text: {text}
+# Accepted date formats: YYYY-MM-DD, DD-MM-YYYY, DD.MM.YYYY, DD/MM/YYYY
+DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})|(\d{1,2})([-./])(\d{1,2})\5(\d{4})')
+TIME_RE = re.compile(r'(\d{1,2}):(\d{1,2})')
 
-{format_instructions}
-""")
+# Relative dates understood without parsing; a blank date means today
+TODAY = frozenset({'today', 'сегодня', ''})
+TOMORROW = frozenset({'tomorrow', 'завтра'})
 
 def normalize_datetime(date_str: str, time_str: str) -> datetime:
     """Normalize date and time strings to datetime object."""
     # Get current time in Asia/Yekaterinburg timezone
-    tz = timezone(timedelta(hours=5))  # UTC+5 for Yekaterinburg
-    now = datetime.now(tz).replace(tzinfo=None)
+    now = datetime.now(YEKAT_TZ)
     
     # Handle relative dates
-    date_lower = date_str.lower()
-    if date_lower == 'today' or '' or 'сегодня':
-        date = now.date()
-    elif date_lower == 'tomorrow' or 'завтра':
-        date = (now + timedelta(days=1)).date()
+    # The LLM may return null for a date it left blank
+    date_lower = (date_str or '').lower()
+    if date_lower in TODAY:
+        event_date = now.date()
+    elif date_lower in TOMORROW:
+        event_date = (now + timedelta(days=1)).date()
     else:
+        match = DATE_RE.fullmatch(date_str)
         try:
-            # Try parsing the date in various formats
-            for fmt in ['%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%Y']:
-                try:
-                    date = datetime.strptime(date_str, fmt).date()
-                    break
-                except ValueError:
-                    continue
-            else:
+            if match is None:
                 raise ValueError("Unsupported date format")
+            if match.group(1):
+                year, month, day = match.group(1, 2, 3)
+            else:
+                day, month, year = match.group(4, 6, 7)
+            event_date = date(int(year), int(month), int(day))
         except ValueError:
             raise ValueError("Please provide date in YYYY-MM-DD format or use 'today'/'tomorrow'")
     
     # Parse time
     try:
-        # Try 24-hour format first
-        time = datetime.strptime(time_str, '%H:%M').time()
+        # Only the 24-hour format is supported
+        match = TIME_RE.fullmatch(time_str or '')
+        if match is None:
+            raise ValueError("Unsupported time format")
+        event_time = time(int(match.group(1)), int(match.group(2)))
     except ValueError:
         raise ValueError("Please provide time in HH:MM format (24-hour)")
             
     # Combine date and time
-    dt = datetime.combine(date, time)
+    dt = datetime.combine(event_date, event_time, tzinfo=YEKAT_TZ)
     
     # Ensure event is not in the past
     if dt < now:
-        if date_lower == 'today':
+        if date_lower in TODAY:
             raise ValueError("Cannot create events in the past. Please specify a future time.")
         
     return dt
 
-async def create_calendar_event(event_details):
+async def create_calendar_event(service, event_details):
     """Create a calendar event using Google Calendar API."""
     try:
-        service = get_google_calendar_service()
-        
         if not event_details.get('time'):
             raise ValueError("Time are required")
         
@@ -159,68 +332,71 @@ async def create_calendar_event(event_details):
         
         if event_details.get('person'):
             event['description'] = f"Meeting with {event_details['person']}"
-        logging.info(f'Final event: {event}')
-        event = service.events().insert(calendarId='primary', body=event).execute()
+        logging.info('Final event: %s', event)
+        # googleapiclient is blocking, so run the request off the event loop
+        event = await asyncio.to_thread(
+            execute_request, service.events().insert(calendarId='primary', body=event))
         return event.get('htmlLink')
     except Exception as e:
         raise ValueError(f"Failed to create calendar event: {str(e)}")
 
 async def get_today_events(service):
     """Get today's events from calendar."""
-    tz = timezone(timedelta(hours=5))  # UTC+5 for Yekaterinburg
-    now = datetime.now(tz)
+    now = datetime.now(YEKAT_TZ)
     
-    today_start = datetime.combine(now.date(), datetime.min.time()).astimezone(tz)
-    today_end = datetime.combine(now.date(), datetime.max.time()).astimezone(tz)
+    today_start = datetime.combine(now.date(), time.min, tzinfo=YEKAT_TZ)
+    today_end = datetime.combine(now.date(), time.max, tzinfo=YEKAT_TZ)
     
-    events_result = service.events().list(
+    events_result = await asyncio.to_thread(execute_request, service.events().list(
         calendarId='primary',
         timeMin=today_start.isoformat(),
         timeMax=today_end.isoformat(),
         singleEvents=True,
-        orderBy='startTime'
-    ).execute()
+        orderBy='startTime',
+        # Only the fields the reply uses, to keep the response small
+        fields='items(summary,start/dateTime,start/date)',
+        maxResults=50
+    ))
     
     return events_result.get('items', [])
 
+def log_task_exception(task: asyncio.Task):
+    """Log the failure of a background task so its exception is never left unretrieved."""
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning('Background task failed: %s', task.exception())
+
+async def get_service(service_task):
+    """Return the Calendar service from the warm-up task, or build it now if none was started."""
+    if service_task is not None:
+        return await service_task
+    return await asyncio.to_thread(get_google_calendar_service)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming messages and process requests."""
     try:
-        logging.info(f"Received a message: {update.message.text}")
+        logging.info("Received a message: %s", update.message.text)
 
-        # OpenAI Client Setup
-        client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=os.getenv("OPENROUTER_API_KEY"),
-        )
+        # Show the typing indicator while the LLM call is in flight
+        typing_task = asyncio.create_task(update.message.chat.send_action(ChatAction.TYPING))
+        typing_task.add_done_callback(log_task_exception)
 
-        # First, classify the request
-        _classifier_prompt = classifier_prompt.format_messages(
-            text=update.message.text,
-            format_instructions=request_classifier.get_format_instructions()
-        )
-        
-        classifier_completion = client.chat.completions.create(
-            extra_headers={
-                "HTTP-Referer": "",
-                "X-Title": "",
-            },
-            model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": _classifier_prompt[0].content
-                }
-            ]
-        )
-        
-        request_type = request_classifier.parse(classifier_completion.choices[0].message.content)
-        logging.info(f'Request type: {request_type}')
+        # Prepare the Calendar service meanwhile too, but only with saved credentials:
+        # without them this would start the OAuth flow before the request is known
+        service_task = None
+        if os.path.exists('token.json'):
+            service_task = asyncio.create_task(asyncio.to_thread(get_google_calendar_service))
+            service_task.add_done_callback(log_task_exception)
+
+        # Obvious "show today" requests skip the LLM entirely
+        request_details = classify_without_llm(update.message.text)
+        if request_details is None:
+            # Classify the request and extract event details in a single call
+            request_details = await ask_llm(build_request_messages(normalize_text(update.message.text)))
+        logging.info('Request details: %s', request_details)
 
-        if request_type['type'] == 'show_today':
+        if request_details['type'] == 'show_today':
             # Handle show today's events request
-            service = get_google_calendar_service()
-            events = await get_today_events(service)
+            events = await get_today_events(await get_service(service_task))
             
             if not events:
                 await update.message.reply_text("No events scheduled for today.")
@@ -229,38 +405,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response = "Today's events:\n\n"
             for event in events:
                 start = event['start'].get('dateTime', event['start'].get('date'))
-                start_time = datetime.fromisoformat(start).astimezone(timezone(timedelta(hours=5)))
-                response += f"• {start_time.strftime('%H:%M')} - {event['summary']}\n"
+                start_time = datetime.fromisoformat(start).astimezone(YEKAT_TZ)
+                response += f"• {start_time.strftime('%H:%M')} - {event.get('summary', '(no title)')}\n"
             
             await update.message.reply_text(response)
             
-        elif request_type['type'] == 'add_event':
-            # Format the event prompt
-            _event_prompt = event_prompt.format_messages(
-                text=request_type['original_text'],
-                format_instructions=event_parser.get_format_instructions()
-            )
+        elif request_details['type'] == 'add_event':
+            missing = [key for key in EVENT_KEYS if key not in request_details]
+            if missing:
+                raise ValueError(f"Model response is missing event fields: {', '.join(missing)}")
 
-            # Get event details
-            event_completion = client.chat.completions.create(
-                extra_headers={
-                    "HTTP-Referer": "",
-                    "X-Title": "",
-                },
-                model=model,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": _event_prompt[0].content
-                    }
-                ]
-            )
-            
-            event_details = event_parser.parse(event_completion.choices[0].message.content)
-            logging.info(f'Event details: {event_details}')
-            
             # Create calendar event
-            event_link = await create_calendar_event(event_details)
+            event_link = await create_calendar_event(await get_service(service_task), request_details)
             await update.message.reply_text(f"Event created successfully!\nView it here: {event_link}")
         
         else:
@@ -283,17 +439,48 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "2. View today's events (e.g., 'What's on my schedule today?')"
     )
 
+def setup_logging() -> QueueListener:
+    """Send log records through a queue so file writes happen on a background thread."""
+    log_queue = queue.SimpleQueue()
+    file_handler = RotatingFileHandler("bot.log", maxBytes=5_000_000, backupCount=3, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    listener = QueueListener(log_queue, file_handler)
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    return listener
+
 def main():
-    logging.info(f"Start the bot")
+    log_listener = setup_logging()
+    logging.info("Start the bot")
     # Create application
-    application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+    application = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_TOKEN'))
+        # Outbound Bot API calls and getUpdates polling use separate pools
+        .connection_pool_size(32)
+        .pool_timeout(10.0)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(30.0)
+        .connect_timeout(10.0)
+        .read_timeout(30.0)
+        .rate_limiter(AIORateLimiter())
+        # Handle messages concurrently so one slow LLM or Calendar call does not hold up the rest
+        .concurrent_updates(True)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     # Run the bot
-    application.run_polling()
+    try:
+        application.run_polling()
+    finally:
+        log_listener.stop()
 
 if __name__ == '__main__':
     main()